@@ -1,97 +1,179 @@
-import yfinance as yf
 import pandas as pd
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 import os
-import matplotlib.pyplot as plt
 import io
-import json
-from datetime import datetime, date, timedelta
-import pytz
+import orjson
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
 
 # --- 設定區 ---
 TICKERS = {
     "US": "NKE",
     "TW": "9910.TW"
 }
+# 歷史價格區間 (圖表與相關係數共用；相關係數只需最近 30 筆)
+HISTORY_PERIOD = "3mo"
+HISTORY_LABEL = "3-Month"
 DISCORD_WEBHOOK_URL = os.environ.get("DISCORD_WEBHOOK_URL")
+TW_TZ = timezone(timedelta(hours=8))  # 台灣無日光節約時間，固定 UTC+8
+
+# 共用連線池 (keep-alive)，避免每次請求重新建立 TLS 連線
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+# 通知中實際用到的基本資料欄位
+INFO_FIELDS = ('trailingPE', 'recommendationKey', 'earningsTimestamp', 'dividendRate', 'dividendYield')
+CACHE_DIR = ".cache"
+CACHE_TTL = 3600  # 秒
+
+# 圖表 Figure 首次繪圖時建立，之後重複使用
+_FIG = None
+_AX = None
+
+def cache_path(key):
+    return os.path.join(CACHE_DIR, f"{key}_{date.today()}.pkl")
+
+def read_cache(key):
+    """讀取當日快取 (超過 CACHE_TTL 視為過期)，沒有則回傳 None"""
+    path = cache_path(key)
+    try:
+        if time.time() - os.path.getmtime(path) > CACHE_TTL:
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+def write_cache(key, value):
+    """寫入當日快取，失敗不影響主流程"""
+    path = cache_path(key)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(path, 'wb') as f:
+            pickle.dump(value, f)
+    except OSError as e:
+        print(f"Cache Error: {e}")
+
+def get_history(ticker_symbols, period=HISTORY_PERIOD):
+    """一次請求抓取多檔收盤價 (用於繪圖與計算)"""
+    cache_key = f"history_{period}_" + "_".join(ticker_symbols)
+    cached = read_cache(cache_key)
+    if cached is not None:
+        return cached
+
+    import yfinance as yf
+
+    print(f"Fetching history for {', '.join(ticker_symbols)}...")
+    df = yf.download(ticker_symbols, period=period, group_by='ticker', threads=True, progress=False)
+
+    # 各市場休市日不同，合併後會有空列，需逐檔移除
+    hist = {sym: df[sym].dropna(how='all') for sym in ticker_symbols}
+    if all(len(h) > 0 for h in hist.values()):
+        write_cache(cache_key, hist)
+    return hist
 
 def get_stock_data(ticker_symbol):
-    """抓取數據：收盤價、基本資料、行事曆"""
+    """抓取數據：基本資料、行事曆"""
+    cache_key = f"info_{ticker_symbol}"
+    cached = read_cache(cache_key)
+    if cached is not None:
+        return cached
+
+    import yfinance as yf
+
     print(f"Fetching data for {ticker_symbol}...")
     stock = yf.Ticker(ticker_symbol)
     
-    # 抓取半年 (6mo) 用於繪圖與計算
-    hist = stock.history(period="6mo")
-    
-    # 基本資料 (使用 get 避免報錯)
+    # 基本資料 (只保留通知用到的欄位)
+    # 只有網路請求本身需要 try，解析改用明確判斷
     try:
-        info = stock.info
-    except:
-        info = {}
+        raw_info = stock.get_info() or {}
+    except Exception as e:
+        print(f"Info Error ({ticker_symbol}): {e}")
+        raw_info = {}
+    info = {k: raw_info[k] for k in INFO_FIELDS if k in raw_info}
     
     # 嘗試抓取行事曆 (較準確的財報日)
     earnings_date = None
     try:
         cal = stock.calendar
-        if isinstance(cal, dict) and 'Earnings Date' in cal:
-            earnings_date = cal['Earnings Date'][0]
-        elif isinstance(cal, pd.DataFrame) and not cal.empty:
-            earnings_date = cal.iloc[0, 0]
-    except:
-        pass
+    except Exception as e:
+        print(f"Calendar Error ({ticker_symbol}): {e}")
+        cal = None
 
-    return stock, hist, info, earnings_date
+    if isinstance(cal, dict):
+        dates = cal.get('Earnings Date')
+        if dates:
+            earnings_date = dates[0]
+    elif isinstance(cal, pd.DataFrame) and not cal.empty:
+        earnings_date = cal.iloc[0, 0]
 
-def calculate_correlation(hist_us, hist_tw):
-    """計算近 30 天相關係數 (修復版：移除時區避免 nan)"""
-    try:
-        # 1. 取出收盤價
-        us_close = hist_us['Close']
-        tw_close = hist_tw['Close']
+    # 只快取成功抓到的基本資料，避免把暫時性失敗保留一小時
+    if info:
+        write_cache(cache_key, (info, earnings_date))
+    return info, earnings_date
 
-        # 2. 移除時區資訊 (關鍵修復)
-        us_close.index = us_close.index.tz_localize(None).normalize()
-        tw_close.index = tw_close.index.tz_localize(None).normalize()
+def to_daily_dates(index):
+    """移除時區並取到日：直接截斷底層 datetime64 值，省去 tz 轉換與 normalize"""
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return index.values.astype('datetime64[D]')
 
-        # 3. 合併數據 (sort=True 消除警告)
-        df = pd.concat([us_close, tw_close], axis=1, keys=['US', 'TW'], sort=True).dropna()
+def calculate_correlation(us_days, us_close, tw_days, tw_close):
+    """計算近 30 天相關係數 (修復版：移除時區避免 nan)"""
+    try:
+        # 1. 取兩市場共同交易日對齊 (日期已移除時區，不需 concat + sort)
+        _, us_i, tw_i = np.intersect1d(us_days, tw_days, assume_unique=True, return_indices=True)
+        a = us_close[us_i]
+        b = tw_close[tw_i]
+        valid = ~(np.isnan(a) | np.isnan(b))
+        a, b = a[valid], b[valid]
 
-        # 4. 取最近 30 筆交易日計算相關係數
-        if len(df) < 10: return 0 
-        corr = df.tail(30).corr().iloc[0, 1]
+        # 2. 取最近 30 筆交易日計算相關係數
+        if len(a) < 10: return 0 
+        corr = np.corrcoef(a[-30:], b[-30:])[0, 1]
         return corr
     except Exception as e:
         print(f"Correlation Error: {e}")
         return 0
 
-def generate_chart(hist_us, hist_tw):
-    """繪製績效比較圖，回傳圖片 buffer"""
-    plt.style.use('dark_background')
-    fig, ax = plt.subplots(figsize=(10, 6))
-    
-    # 移除時區以便繪圖對齊
-    hist_us.index = hist_us.index.tz_localize(None)
-    hist_tw.index = hist_tw.index.tz_localize(None)
+def generate_chart(us_days, us_close, tw_days, tw_close):
+    """繪製績效比較圖，回傳 PNG bytes"""
+    global _FIG, _AX
+    # 延遲載入 matplotlib 並指定無 GUI 的 Agg 後端，縮短啟動時間
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    import matplotlib.pyplot as plt
+
+    # 重複使用同一個 Figure，只清空座標軸
+    if _FIG is None:
+        plt.style.use('dark_background')
+        _FIG, _AX = plt.subplots(figsize=(10, 6), dpi=80)
+    else:
+        _AX.clear()
+    fig, ax = _FIG, _AX
     
     # 正規化數據 (以第一天為基準 0%)
-    if len(hist_us) > 0 and len(hist_tw) > 0:
-        us_norm = (hist_us['Close'] / hist_us['Close'].iloc[0] - 1) * 100
-        tw_norm = (hist_tw['Close'] / hist_tw['Close'].iloc[0] - 1) * 100
+    # 直接以 numpy 陣列繪圖，避開 pandas -> matplotlib 的日期轉換
+    if len(us_close) > 0 and len(tw_close) > 0:
+        us_norm = (us_close / us_close[0] - 1) * 100
+        tw_norm = (tw_close / tw_close[0] - 1) * 100
         
-        ax.plot(us_norm.index, us_norm, label='Nike (NKE)', color='#ff4d4d', linewidth=2)
-        ax.plot(tw_norm.index, tw_norm, label='Feng Tay (9910)', color='#4da6ff', linewidth=2)
+        ax.plot(us_days, us_norm, label='Nike (NKE)', color='#ff4d4d', linewidth=2)
+        ax.plot(tw_days, tw_norm, label='Feng Tay (9910)', color='#4da6ff', linewidth=2)
     
-    ax.set_title("Nike vs Feng Tay: 6-Month Performance Comparison (%)", fontsize=14, color='white')
+    ax.set_title(f"Nike vs Feng Tay: {HISTORY_LABEL} Performance Comparison (%)", fontsize=14, color='white')
     ax.set_ylabel("Change (%)", color='white')
     ax.legend()
     ax.grid(True, alpha=0.3)
     
-    # 儲存圖片到記憶體
+    # 儲存圖片到記憶體 (不用 bbox_inches='tight'，省去額外一次繪製；壓縮 PNG 縮小上傳量)
     buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight')
-    buf.seek(0)
-    plt.close()
-    return buf
+    fig.savefig(buf, format='png', pil_kwargs={'optimize': True})
+    return buf.getvalue()
 
 def get_smart_earnings_date(earnings_date_obj, info_dict):
     """
@@ -128,7 +210,7 @@ def format_number(num, is_percent=False):
     if is_percent: return f"{num * 100:.2f}"
     return f"{num:.2f}"
 
-def send_discord_notification(data, chart_buffer):
+def send_discord_notification(data, chart_bytes):
     if not DISCORD_WEBHOOK_URL:
         print("Error: Discord Webhook URL not found.")
         return
@@ -137,19 +219,19 @@ def send_discord_notification(data, chart_buffer):
     nke = data['nke_info']
     tw = data['tw_info']
     corr = data['correlation']
+    nke_c = data['nke_close']
+    tw_c = data['tw_close']
+    nke_pct, tw_pct = data['pct_change']
 
     # 1. 處理財報日期 (使用新邏輯)
     earnings_str = get_smart_earnings_date(data['earnings_date'], nke)
 
     # 2. 處理殖利率 (避免 548% 錯誤)
-    try:
-        if tw.get('dividendRate') and data['tw_hist']['Close'].iloc[-1]:
-            tw_yield = (tw['dividendRate'] / data['tw_hist']['Close'].iloc[-1]) * 100
-        elif tw.get('dividendYield'):
-             tw_yield = tw['dividendYield'] * 100
-        else:
-            tw_yield = 0
-    except:
+    if tw.get('dividendRate') and tw_c[-1]:
+        tw_yield = (tw['dividendRate'] / tw_c[-1]) * 100
+    elif tw.get('dividendYield'):
+        tw_yield = tw['dividendYield'] * 100
+    else:
         tw_yield = 0
 
     # 3. 相關性文字
@@ -159,30 +241,35 @@ def send_discord_notification(data, chart_buffer):
     elif corr < -0.3: corr_text = "📉 負相關 (背離)"
     else: corr_text = "💔 脫鉤/無明顯相關"
 
-    # 4. 獲取最新價格與漲跌幅
-    nke_close = data['nke_hist']['Close']
-    tw_close = data['tw_hist']['Close']
-    
-    nke_price = nke_close.iloc[-1]
-    nke_pct = (nke_price - nke_close.iloc[-2]) / nke_close.iloc[-2] * 100
-    
-    tw_price = tw_close.iloc[-1]
-    tw_pct = (tw_price - tw_close.iloc[-2]) / tw_close.iloc[-2] * 100
+    # 4. 獲取最新價格
+    nke_price = nke_c[-1]
+    tw_price = tw_c[-1]
 
-    # 5. 建立 Embed
+    # 5. 一次產生所有顯示字串
+    text = {
+        'corr': format_number(corr),
+        'nke_price': format_number(nke_price),
+        'nke_pe': format_number(nke.get('trailingPE')),
+        'nke_rec': (nke.get('recommendationKey') or 'N/A').upper(),
+        'tw_price': format_number(tw_price),
+        'tw_pe': format_number(tw.get('trailingPE')),
+        'tw_yield': format_number(tw_yield),
+    }
+
+    # 6. 建立 Embed
     embed = {
         "title": "👟 豐泰 (9910) vs Nike (NKE) 每日深度追蹤",
-        "description": f"策略觀點：Nike 走勢為豐泰領先指標。相關係數顯示兩者目前為 **{format_number(corr)}** ({corr_text})。",
+        "description": f"策略觀點：Nike 走勢為豐泰領先指標。相關係數顯示兩者目前為 **{text['corr']}** ({corr_text})。",
         "color": 3447003, # 藍色
         "fields": [
             {
                 "name": "🇺🇸 Nike (美股收盤)",
-                "value": f"股價: **${format_number(nke_price)}** ({nke_pct:+.2f}%)\n本益比: {format_number(nke.get('trailingPE'))}\n下次財報: {earnings_str}\n分析師評級: {nke.get('recommendationKey', 'N/A').upper()}",
+                "value": f"股價: **${text['nke_price']}** ({nke_pct:+.2f}%)\n本益比: {text['nke_pe']}\n下次財報: {earnings_str}\n分析師評級: {text['nke_rec']}",
                 "inline": True
             },
             {
                 "name": "🇹🇼 豐泰 (昨日收盤)",
-                "value": f"股價: **NT${format_number(tw_price)}** ({tw_pct:+.2f}%)\n本益比: {format_number(tw.get('trailingPE'))}\n預估殖利率: {format_number(tw_yield)}%",
+                "value": f"股價: **NT${text['tw_price']}** ({tw_pct:+.2f}%)\n本益比: {text['tw_pe']}\n預估殖利率: {text['tw_yield']}%",
                 "inline": True
             }
         ],
@@ -190,17 +277,17 @@ def send_discord_notification(data, chart_buffer):
             "url": "attachment://chart.png"
         },
         "footer": {
-            "text": f"報告生成時間 (TW): {datetime.now(pytz.timezone('Asia/Taipei')).strftime('%Y-%m-%d %H:%M')}"
+            "text": f"報告生成時間 (TW): {datetime.now(TW_TZ).strftime('%Y-%m-%d %H:%M')}"
         }
     }
 
-    # 6. 發送請求 (Multipart)
+    # 7. 發送請求 (Multipart)
     files = {
-        'file': ('chart.png', chart_buffer, 'image/png')
+        'file': ('chart.png', chart_bytes, 'image/png')
     }
-    payload_json = json.dumps({"embeds": [embed]})
+    payload_json = orjson.dumps({"embeds": [embed]}).decode()
     
-    response = requests.post(
+    response = SESSION.post(
         DISCORD_WEBHOOK_URL, 
         data={"payload_json": payload_json},
         files=files
@@ -212,20 +299,44 @@ def send_discord_notification(data, chart_buffer):
         print(f"Failed to send: {response.status_code}, {response.text}")
 
 def main():
+    # 沒有 Webhook 就無法發送，直接結束，不做任何抓取與繪圖
+    if not DISCORD_WEBHOOK_URL:
+        print("Error: DISCORD_WEBHOOK_URL not set; aborting.")
+        return
+
     print("Starting analysis...")
     
-    # 獲取數據
-    nke_s, nke_h, nke_i, nke_e = get_stock_data(TICKERS["US"])
-    tw_s, tw_h, tw_i, tw_e = get_stock_data(TICKERS["TW"])
+    # 獲取數據 (歷史價格合併為單一請求，其餘互不相依，平行抓取)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        hist_future = executor.submit(get_history, [TICKERS["US"], TICKERS["TW"]])
+        nke_future = executor.submit(get_stock_data, TICKERS["US"])
+        tw_future = executor.submit(get_stock_data, TICKERS["TW"])
+        hist = hist_future.result()
+        nke_i, nke_e = nke_future.result()
+        tw_i, tw_e = tw_future.result()
+
+    nke_h = hist[TICKERS["US"]]
+    tw_h = hist[TICKERS["TW"]]
+
+    # 收盤價與日期只轉換一次，供漲跌幅、相關係數與繪圖共用
+    nke_close = nke_h['Close'].to_numpy()
+    tw_close = tw_h['Close'].to_numpy()
+    nke_days = to_daily_dates(nke_h.index)
+    tw_days = to_daily_dates(tw_h.index)
+
+    # 兩檔最近兩日收盤一次算出漲跌幅
+    last_two = np.array([nke_close[-2:], tw_close[-2:]])
+    pct_change = (last_two[:, 1] / last_two[:, 0] - 1) * 100
     
     # 計算與繪圖
-    corr = calculate_correlation(nke_h, tw_h)
-    chart = generate_chart(nke_h, tw_h)
+    corr = calculate_correlation(nke_days, nke_close, tw_days, tw_close)
+    chart = generate_chart(nke_days, nke_close, tw_days, tw_close)
     
     # 打包數據
     data = {
-        'nke_hist': nke_h, 'nke_info': nke_i, 'earnings_date': nke_e,
-        'tw_hist': tw_h, 'tw_info': tw_i,
+        'nke_close': nke_close, 'nke_info': nke_i, 'earnings_date': nke_e,
+        'tw_close': tw_close, 'tw_info': tw_i,
+        'pct_change': pct_change,
         'correlation': corr
     }
     